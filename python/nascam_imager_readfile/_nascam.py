@@ -1,17 +1,35 @@
 import signal
-import cv2
-import tarfile
+import sys
 import os
+import re
+import mmap
+import struct
 import datetime
+import functools
 import numpy as np
-from multiprocessing import Pool
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
+try:
+    from multiprocessing.shared_memory import SharedMemory
+except ImportError:  # pragma: no cover
+    SharedMemory = None  # Python < 3.8
 
 # static globals
 __EXPECTED_FRAME_COUNT = 20
 __PNG_METADATA_PROJECT_UID = "nascam"
+__PNG_METADATA_COLUMNS = (
+    "Site unique ID",
+    "Imager unique ID",
+    "Mode unique ID",
+    "Image request start",
+    "Subframe requested exposure",
+)
+__MAX_DECODE_THREADS = 4
+__PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+__PNG_FILENAME_REGEX = re.compile(r"\A\d{8}_\d{6}_[^_]+_[^_]+_[^_]+_\d+(\.\d+)?ms\.png\Z")
 
 # dynamic globals
-__worker_tar_tempdir = ""
+__worker_shared_buffer = None
 
 
 def read(file_list, workers=1, tar_tempdir="."):
@@ -21,98 +39,231 @@ def read(file_list, workers=1, tar_tempdir="."):
 
     :param file_list: filename or list of filenames
     :type file_list: str
-    :param workers: number of worker processes to spawn, defaults to 1
+    :param workers: number of worker processes to spawn, None for one per CPU, defaults to 1
     :type workers: int, optional
-    :param tar_tempdir: path to untar to, defaults to '.'
+    :param tar_tempdir: unused, PNG.TAR files are now read in memory; kept for
+        backwards compatibility, defaults to '.'
     :type tar_tempdir: str, optional
 
     :return: images, metadata dictionaries, and problematic files
     :rtype: numpy.ndarray, list[dict], list[dict]
     """
-    # set globals
-    global __worker_tar_tempdir
-    __worker_tar_tempdir = tar_tempdir
-
-    # set up process pool (ignore SIGINT before spawning pool so child processes inherit SIGINT handler)
-    original_sigint_handler = signal.signal(signal.SIGINT, signal.SIG_IGN)
-    pool = Pool(processes=workers)
-    signal.signal(signal.SIGINT, original_sigint_handler)  # restore SIGINT handler
+    # check the number of workers (the decoding threads are shared between them), None uses all CPUs
+    if (workers is None):
+        workers = os.cpu_count() or 1
+    if (workers < 1):
+        raise ValueError("Number of processes must be at least 1")
 
     # if input is just a single file name in a string, convert to a list to be fed to the workers
     if isinstance(file_list, str):
         file_list = [file_list]
 
-    # call readfile function, run each iteration with a single input file from file_list
-    pool_data = []
-    try:
-        pool_data = pool.map(__nascam_readfile_worker, file_list)
-    except KeyboardInterrupt:
-        pool.terminate()  # gracefully kill children
-        return np.empty((0, 0)), [], []
-    else:
-        pool.close()
-
-    # set sizes
-    image_width = pool_data[0][5]
-    image_height = pool_data[0][6]
-    image_dtype = pool_data[0][7]
+    # a single file is read in this process, there is nothing to parallelize or reorganize (optimization)
+    if (len(file_list) == 1):
+        try:
+            worker_data = __nascam_readfile_worker({
+                "filename": file_list[0],
+                "decode_threads": max(1, min(__MAX_DECODE_THREADS, os.cpu_count() or 1)),
+                "shm_name": None,
+                "shm_inherited": False,
+                "shm_frame_shape": None,
+                "shm_slot": 0,
+            })
+        except KeyboardInterrupt:
+            return np.empty((0, 0)), [], []
+        problematic_file_list = []
+        if (worker_data[2] is True):
+            problematic_file_list.append({
+                "filename": worker_data[3],
+                "error_message": worker_data[4],
+            })
+        images = worker_data[0]
+        if (images.size == 0):
+            images = np.empty([0, 0, 0], dtype=worker_data[7])
+        return images.transpose(1, 2, 0), __metadata_columns_to_dict_list(worker_data[1]), problematic_file_list
 
-    # pre-allocate array sizes (optimization)
+    # pre-allocate array sizes (optimization), the image array is allocated once the frame size is known
     predicted_num_frames = len(file_list) * __EXPECTED_FRAME_COUNT
-    images = np.empty([image_width, image_height, predicted_num_frames], dtype=image_dtype)
-    metadata_dict_list = [{}] * predicted_num_frames
+    images = None
+    image_dtype = np.uint16
+    metadata_columns = __empty_metadata_columns()
     problematic_file_list = []
-
-    # reorganize data
     list_position = 0
-    for i in range(0, len(pool_data)):
-        # check if file was problematic
-        if (pool_data[i][2] is True):
-            problematic_file_list.append({
-                "filename": pool_data[i][3],
-                "error_message": pool_data[i][4],
+
+    # the shared memory and process pool are set up inside the try so that they are always cleaned up
+    global __worker_shared_buffer
+    shm = None
+    shm_images = None
+    images_in_shm = False
+    pool = None
+    try:
+        # set up shared memory for the workers to write frames into, avoiding pickling the images back
+        # to this process (optimization); each file gets a slot of the expected number of frames
+        #
+        # NOTE: when forking, this is an anonymous mapping inherited by the workers, and the frames are
+        # returned straight from it; otherwise it is named shared memory, copied out once at the end
+        fork = sys.platform.startswith("linux")
+        shm, shared_buffer, shm_frame_shape = __create_shared_memory(file_list, predicted_num_frames, inherited=fork)
+        if (shared_buffer is not None):
+            shm_images = np.ndarray([predicted_num_frames] + list(shm_frame_shape), dtype=np.uint16, buffer=shared_buffer)
+        __worker_shared_buffer = shared_buffer if shm is None else None
+        shared_buffer = None
+
+        # set up processing objects, sharing the CPUs between worker processes for PNG decoding threads
+        busy_workers = max(1, min(workers, len(file_list)))
+        decode_threads = max(1, min(__MAX_DECODE_THREADS, (os.cpu_count() or 1) // busy_workers))
+        processing_list = []
+        for i in range(0, len(file_list)):
+            processing_list.append({
+                "filename": file_list[i],
+                "decode_threads": decode_threads,
+                "shm_name": shm.name if shm is not None else None,
+                "shm_inherited": __worker_shared_buffer is not None,
+                "shm_frame_shape": shm_frame_shape,
+                "shm_slot": i,
             })
 
-        # check if any data was read in
-        if (len(pool_data[i][1]) == 0):
-            continue
+        # import the decoders before forking so the workers inherit them instead of each importing them
+        import cv2  # noqa: F401
+        __import_pyspng()
+
+        # set up process pool (ignore SIGINT before spawning pool so child processes inherit SIGINT handler)
+        #
+        # NOTE: on Linux the workers are always forked, which is cheap and doesn't need to re-import this
+        # module in each worker; elsewhere the platform default is kept since forking is unsafe on macOS
+        original_sigint_handler = signal.signal(signal.SIGINT, signal.SIG_IGN)
+        try:
+            mp_context = multiprocessing.get_context("fork" if fork is True else None)
+            pool = mp_context.Pool(processes=workers)
+        finally:
+            signal.signal(signal.SIGINT, original_sigint_handler)  # restore SIGINT handler
+
+        # call readfile function, run each iteration with a single input file from file_list, and
+        # copy the results into the pre-allocated arrays as they arrive (in file order)
+        #
+        # NOTE: files are handed out one at a time, so a worker that finishes early (ie. a file with
+        # dropped frames) takes the next file instead of sitting idle while others work through a fixed chunk
+        for i, worker_data in enumerate(pool.imap(__nascam_readfile_worker, processing_list, chunksize=1)):
+            # check if file was problematic
+            if (worker_data[2] is True):
+                problematic_file_list.append({
+                    "filename": worker_data[3],
+                    "error_message": worker_data[4],
+                })
+
+            # check if any data was read in
+            real_num_frames = len(worker_data[1]["Image request start"])
+            if (real_num_frames == 0):
+                continue
+
+            # allocate image array, frame-major so that each frame is contiguous in memory; the shared
+            # memory is used when the frames match it, compacting the slots in place as they arrive
+            image_width = worker_data[5]
+            image_height = worker_data[6]
+            if (images is None):
+                image_dtype = worker_data[7]
+                if (shm_images is not None and (image_width, image_height) == shm_frame_shape):
+                    images = shm_images
+                    images_in_shm = shm is not None
+                else:
+                    images = np.empty([predicted_num_frames, image_width, image_height], dtype=image_dtype)
 
-        # find actual number of frames, this may differ from predicted due to dropped frames, end
-        # or start of imaging
-        real_num_frames = pool_data[i][0].shape[-1]
+            # move to a private array if the frames would run past the end of the array, or into the next
+            # slot of the shared memory (which a worker may have already written to)
+            end_position = list_position + real_num_frames
+            if (end_position > images.shape[0] or (images is shm_images and end_position > (i + 1) * __EXPECTED_FRAME_COUNT)):
+                remaining_num_frames = (len(file_list) - i - 1) * __EXPECTED_FRAME_COUNT
+                new_images = np.empty([end_position + remaining_num_frames, image_width, image_height], dtype=image_dtype)
+                new_images[0:list_position] = images[0:list_position]
+                images = new_images
+                images_in_shm = False
+                new_images = None
+
+            # metadata columns at data[1], images at data[0] or in the shared memory slot; the actual
+            # number of frames may differ from predicted due to dropped frames, end or start of imaging
+            for key in __PNG_METADATA_COLUMNS:
+                metadata_columns[key].extend(worker_data[1][key])
+            if (worker_data[0] is None):
+                slot_position = i * __EXPECTED_FRAME_COUNT
+                images[list_position:end_position] = shm_images[slot_position:slot_position + real_num_frames]
+            else:
+                images[list_position:end_position] = worker_data[0]
+            list_position = end_position  # advance list position
+            worker_data = None
 
-        # metadata dictionary list at data[][1]
-        metadata_dict_list[list_position:list_position + real_num_frames] = pool_data[i][1]
-        images[:, :, list_position:list_position + real_num_frames] = pool_data[i][0]
-        list_position = list_position + real_num_frames  # advance list position
+        # trim unused elements from predicted array sizes; named shared memory is released below, so the
+        # frames are copied out of it once
+        if (images is not None):
+            images = images[0:list_position]
+            if (images_in_shm is True):
+                images = images.copy()
+                images_in_shm = False
+    except KeyboardInterrupt:
+        if (pool is not None):
+            pool.terminate()  # gracefully kill children
+        return np.empty((0, 0)), [], []
+    except Exception:
+        if (pool is not None):
+            pool.terminate()  # don't leave children running
+        raise
+    else:
+        pool.close()
+    finally:
+        # release shared memory
+        __worker_shared_buffer = None
+        shm_images = None
+        if (images_in_shm is True):
+            images = None
+        if (shm is not None):
+            shm.close()
+            shm.unlink()
 
-    # trim unused elements from predicted array sizes
-    metadata_dict_list = metadata_dict_list[0:list_position]
-    images = np.delete(images, range(list_position, predicted_num_frames), axis=2)
+    # no data was read in
+    if (images is None):
+        images = np.empty([0, 0, 0], dtype=image_dtype)
 
-    # ensure entire array views as the dtype
-    images = images.astype(image_dtype)
+    # move frames to the last axis (a view, no copy)
+    images = images.transpose(1, 2, 0)
 
     # return
-    pool_data = None
-    return images, metadata_dict_list, problematic_file_list
+    return images, __metadata_columns_to_dict_list(metadata_columns), problematic_file_list
+
 
+def __empty_metadata_columns():
+    return {key: [] for key in __PNG_METADATA_COLUMNS}
 
-def __nascam_readfile_worker(file):
+
+def __metadata_columns_to_dict_list(metadata_columns):
+    # workers return metadata as one list per field (less to pickle and hold while reading), expand
+    # it to a dictionary per frame only when returning to the caller
+    metadata_dict_list = []
+    for site_uid, device_uid, mode_uid, timestamp, exposure in zip(*[metadata_columns[key] for key in __PNG_METADATA_COLUMNS]):
+        metadata_dict_list.append({
+            "Project unique ID": __PNG_METADATA_PROJECT_UID,
+            "Site unique ID": site_uid,
+            "Imager unique ID": device_uid,
+            "Mode unique ID": mode_uid,
+            "Image request start": timestamp,
+            "Subframe requested exposure": exposure,
+        })
+    return metadata_dict_list
+
+
+def __nascam_readfile_worker(file_obj):
     # init
+    file = file_obj["filename"]
     images = np.array([])
-    metadata_dict_list = []
+    metadata_columns = __empty_metadata_columns()
     problematic = False
     error_message = ""
     image_width = 0
     image_height = 0
-    image_dtype = np.dtype("uint16")
-    image_dtype = image_dtype.newbyteorder('>')
+    image_dtype = np.uint16
 
     # check file extension to know how to process
     try:
         if (file.endswith("png") or file.endswith("png.tar")):
-            return __nascam_readfile_worker_png(file)
+            return __nascam_readfile_worker_png(file_obj)
         else:
             print("Unrecognized file type: %s" % (file))
     except Exception as e:
@@ -121,105 +272,248 @@ def __nascam_readfile_worker(file):
         print("Failed to process file '%s' " % (file))
         problematic = True
         error_message = "failed to process file: %s" % (str(e))
-    return images, metadata_dict_list, problematic, file, error_message, \
+    return images, metadata_columns, problematic, file, error_message, \
         image_width, image_height, image_dtype
 
 
-def __nascam_readfile_worker_png(file):
+def __create_shared_memory(file_list, num_frames, inherited=False):
+    # returns the named shared memory (None if inherited), its buffer, and the frame shape; an inherited
+    # buffer is an anonymous shared mapping that forked workers can see without attaching to it by name
+    if (len(file_list) == 0 or (inherited is False and SharedMemory is None)):  # Python 3.8+ for named
+        return None, None, None
+    import shutil
+    import tarfile
+
+    # find the frame size from the PNG header of the first frame
+    file = file_list[0]
+    try:
+        if (file.endswith(".png.tar")):
+            with tarfile.open(file) as tf:
+                member = next(m for m in tf if m.isfile())
+                png_header = tf.extractfile(member).read(24)
+        else:
+            with open(file, "rb") as fp:
+                png_header = fp.read(24)
+        if (png_header[0:8] != __PNG_SIGNATURE):
+            return None, None, None
+        frame_width, frame_height = struct.unpack(">II", png_header[16:24])
+    except Exception:
+        return None, None, None
+
+    # check there is room for it (a full /dev/shm would crash the workers instead of raising an error)
+    size = num_frames * frame_height * frame_width * np.dtype(np.uint16).itemsize
+    if (size == 0):
+        return None, None, None
+    if (inherited is False and os.path.isdir("/dev/shm") and shutil.disk_usage("/dev/shm").free < size):
+        return None, None, None
+
+    # create shared memory
+    try:
+        if (inherited is True):
+            return None, mmap.mmap(-1, size), (frame_height, frame_width)
+        shm = SharedMemory(create=True, size=size)
+    except Exception:
+        return None, None, None
+    return shm, shm.buf, (frame_height, frame_width)
+
+
+@functools.lru_cache(maxsize=4096)
+def __parse_timestamp_minute(minute_str):
+    return datetime.datetime(
+        int(minute_str[0:4]),
+        int(minute_str[4:6]),
+        int(minute_str[6:8]),
+        int(minute_str[9:11]),
+        int(minute_str[11:13]),
+    )
+
+
+def __parse_timestamp(filename):
+    # the timestamp is at fixed offsets (YYYYMMDD_HHMMSS_...), slicing is much faster than strptime; the
+    # frames in a file share the same few minutes, so the minute is cached and the seconds added to it
+    if (filename[8:9] != "_" or filename[15:16] != "_"):
+        raise ValueError("unexpected filename format '%s'" % (filename))
+    return __parse_timestamp_minute(filename[0:13]) + datetime.timedelta(seconds=int(filename[13:15]))
+
+
+def __parse_png_metadata(f):
+    # returns the values for __PNG_METADATA_COLUMNS
+    filename = os.path.basename(f)
+    timestamp = __parse_timestamp(filename)
+    file_split = filename.split('_', 6)
+    site_uid = file_split[2]
+    device_uid = file_split[3]
+    mode_uid = file_split[4]
+    exposure = "%.03f ms" % (float(file_split[5][:-6]))
+    return site_uid, device_uid, mode_uid, timestamp, exposure
+
+
+@functools.lru_cache(maxsize=None)
+def __import_pyspng():
+    # optional, faster PNG decoding
+    try:
+        import pyspng
+    except ImportError:  # pragma: no cover
+        return None
+    return pyspng
+
+
+def __decode_png(file_data):
+    import cv2
+
+    # use libspng for 8-bit grayscale frames if available (faster), otherwise OpenCV
+    pyspng = __import_pyspng()
+    if (pyspng is not None and file_data[24:26] == b"\x08\x00"):
+        image_np = pyspng.load(bytes(file_data))
+        if (image_np.ndim == 2):
+            return image_np
+    return cv2.imdecode(np.frombuffer(file_data, dtype=np.uint8), cv2.IMREAD_GRAYSCALE | cv2.IMREAD_ANYDEPTH)
+
+
+def __nascam_readfile_worker_png(file_obj):
+    import tarfile
+
     # init
+    file = file_obj["filename"]
     images = np.array([])
-    metadata_dict_list = []
+    metadata_columns = __empty_metadata_columns()
     problematic = False
-    first_frame = True
     error_message = ""
     image_width = 0
     image_height = 0
     image_dtype = np.uint16
-    is_tar_file = False
+    num_written = 0
+    shm = None
+    shared_buffer = None
 
     # check if it's a tar file
     file_list = []
+    file_data_list = []
     if (file.endswith(".png.tar")):
-        # tar file, extract all frames and add to list
+        # tar file, read all frames into memory and add to list
         try:
-            tf = tarfile.open(file)
-            file_list = sorted(tf.getnames())
-            tf.extractall(path=__worker_tar_tempdir)
-            for i in range(0, len(file_list)):
-                file_list[i] = "%s/%s" % (__worker_tar_tempdir, file_list[i])
+            # map the file into memory and take zero-copy views of the members (optimization), so the
+            # frames are decoded straight from the page cache; compressed or sparse members are read out
+            with open(file, "rb") as fp:
+                tar_mmap = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+            tar_view = memoryview(tar_mmap)
+            tf = tarfile.open(fileobj=tar_mmap)
+            frames = []
+            for m in tf:
+                if (m.isfile() is False):
+                    continue
+                if (tf.fileobj is tar_mmap and m.issparse() is False):
+                    frames.append((m.name, tar_view[m.offset_data:m.offset_data + m.size]))
+                else:
+                    frames.append((m.name, tf.extractfile(m).read()))
             tf.close()
-            is_tar_file = True
+            frames.sort(key=lambda frame: frame[0])
+            file_list = [frame[0] for frame in frames]
+            file_data_list = [frame[1] for frame in frames]
         except Exception as e:
-            if ("file_list" in locals()):
-                # cleanup
-                for f in file_list:
-                    try:
-                        os.remove(f)
-                    except Exception:
-                        pass
             print("Failed to open file '%s' " % (file))
             problematic = True
             error_message = "failed to open file: %s" % (str(e))
-            return images, metadata_dict_list, problematic, file, error_message, \
+            return images, metadata_columns, problematic, file, error_message, \
                 image_width, image_height, image_dtype
     else:
         # regular png
-        file_list = [file]
-
-    # read each png file
-    for f in file_list:
-        # process metadata
         try:
-            # set metadata values
-            file_split = os.path.basename(f).split('_')
-            site_uid = file_split[2]
-            device_uid = file_split[3]
-            mode_uid = file_split[4]
-            exposure = "%.03f ms" % (float(file_split[5][:-6]))
-            timestamp = datetime.datetime.strptime("%sT%s" % (file_split[0], file_split[1]), "%Y%m%dT%H%M%S")
-
-            # set the metadata dict
-            metadata_dict = {
-                "Project unique ID": __PNG_METADATA_PROJECT_UID,
-                "Site unique ID": site_uid,
-                "Imager unique ID": device_uid,
-                "Mode unique ID": mode_uid,
-                "Image request start": timestamp,
-                "Subframe requested exposure": exposure,
-            }
-            metadata_dict_list.append(metadata_dict)
+            with open(file, "rb") as fp:
+                file_data_list = [fp.read()]
+            file_list = [file]
         except Exception as e:
-            print("Failed to read metadata from file '%s' " % (f))
+            print("Failed to open file '%s' " % (file))
             problematic = True
-            error_message = "failed to read metadata: %s" % (str(e))
-            break
+            error_message = "failed to open file: %s" % (str(e))
+            return images, metadata_columns, problematic, file, error_message, \
+                image_width, image_height, image_dtype
+
+    # decode all png files, in parallel threads (cv2 releases the GIL while decoding)
+    executor = ThreadPoolExecutor(max_workers=max(1, min(len(file_data_list), file_obj["decode_threads"])))
+    decode_futures = [executor.submit(__decode_png, file_data) for file_data in file_data_list]
+    file_data_list = None
+
+    # process metadata of all png files at once if the filenames are all well-formed (optimization),
+    # otherwise it is done frame by frame below, stopping at the first bad one; this only removes the
+    # per-frame metadata try, each frame's image decode is still checked individually below
+    frame_metadata_list = None
+    if (all(__PNG_FILENAME_REGEX.match(os.path.basename(f)) for f in file_list)):
+        try:
+            frame_metadata_list = [__parse_png_metadata(f) for f in file_list]
+        except Exception:
+            frame_metadata_list = None
+
+    # read each png file
+    for i, (f, decode_future) in enumerate(zip(file_list, decode_futures)):
+        # process metadata
+        if (frame_metadata_list is not None):
+            frame_metadata = frame_metadata_list[i]
+        else:
+            try:
+                frame_metadata = __parse_png_metadata(f)
+            except Exception as e:
+                print("Failed to read metadata from file '%s' " % (f))
+                problematic = True
+                error_message = "failed to read metadata: %s" % (str(e))
+                break
 
         # read png file
         try:
-            # read file
-            image_np = cv2.imread(f, cv2.IMREAD_GRAYSCALE)
-            image_width = image_np.shape[0]
-            image_height = image_np.shape[1]
-            image_matrix = np.reshape(image_np, (image_width, image_height, 1))
-
-            # initialize image stack
-            if (first_frame is True):
-                images = image_matrix
-                first_frame = False
-            else:
-                images = np.dstack([images, image_matrix])  # depth stack images (on last axis)
+            # get decoded file
+            image_np = decode_future.result()
+
+            # pre-allocate image stack once the frame dimensions are known (optimization), using
+            # this file's shared memory slot if the frames fit in it
+            if (images.size == 0):
+                image_width = image_np.shape[0]
+                image_height = image_np.shape[1]
+                fits_shm = (len(file_list) <= __EXPECTED_FRAME_COUNT and image_np.shape == file_obj["shm_frame_shape"])
+                if (fits_shm is True and file_obj["shm_inherited"] is True):
+                    shared_buffer = __worker_shared_buffer
+                elif (fits_shm is True and file_obj["shm_name"] is not None):
+                    shm = SharedMemory(name=file_obj["shm_name"])
+                    shared_buffer = shm.buf
+                if (shared_buffer is not None):
+                    slot_size = __EXPECTED_FRAME_COUNT * image_np.size * np.dtype(image_dtype).itemsize
+                    images = np.ndarray(
+                        [__EXPECTED_FRAME_COUNT, image_width, image_height],
+                        dtype=image_dtype,
+                        buffer=shared_buffer,
+                        offset=file_obj["shm_slot"] * slot_size,
+                    )[0:len(file_list)]
+                else:
+                    images = np.empty([len(file_list), image_width, image_height], dtype=image_dtype)
+
+            # add frame to the image stack (frame-major, on first axis)
+            images[num_written] = image_np
+            num_written += 1
         except Exception as e:
             print("Failed reading image data frame: %s" % (str(e)))
-            metadata_dict_list.pop()  # remove corresponding metadata entry
             problematic = True
             error_message = "image data read failure: %s" % (str(e))
             continue  # skip to next frame
 
-    # remove untarred files
-    if (is_tar_file is True):
-        for f in file_list:
-            os.remove(f)
+        # add to the metadata columns
+        for key, value in zip(__PNG_METADATA_COLUMNS, frame_metadata):
+            metadata_columns[key].append(value)
+
+    # stop decoding threads, cancelling any frames left undecoded after a failure
+    for decode_future in decode_futures:
+        decode_future.cancel()
+    executor.shutdown(wait=True)
+
+    # trim unused frames (failed reads)
+    if (images.size > 0):
+        images = images[0:num_written]
+
+    # frames were written to shared memory, release it
+    if (shared_buffer is not None):
+        images = None
+        shared_buffer = None
+    if (shm is not None):
+        shm.close()
 
     # return
-    return images, metadata_dict_list, problematic, file, error_message, \
+    return images, metadata_columns, problematic, file, error_message, \
         image_width, image_height, image_dtype
@@ -0,0 +1,247 @@
+import io
+import tarfile
+import datetime
+import cv2
+import numpy as np
+import pytest
+import nascam_imager_readfile
+from nascam_imager_readfile import _nascam
+
+
+def write_png_tar(path, frames, names=None, mode="w"):
+    # write frames to a PNG.TAR file, using the NASCAM frame filename format unless names are given
+    if (names is None):
+        names = ["20200101_0600%02d_atha_nascam02_full_2000ms.png" % (i) for i in range(0, len(frames))]
+    with tarfile.open(str(path), mode) as tf:
+        for name, frame in zip(names, frames):
+            png_data = frame if isinstance(frame, bytes) else cv2.imencode(".png", frame)[1].tobytes()
+            tar_info = tarfile.TarInfo(name)
+            tar_info.size = len(png_data)
+            tf.addfile(tar_info, io.BytesIO(png_data))
+    return str(path)
+
+
+def make_frames(num_frames, seed=0):
+    rng = np.random.RandomState(seed)
+    return [rng.randint(0, 256, (24, 32)).astype(np.uint8) for _ in range(0, num_frames)]
+
+
+def read_each(file_list):
+    # read files one at a time and concatenate the results
+    images = []
+    metadata = []
+    for f in file_list:
+        img, meta, _ = nascam_imager_readfile.read(f)
+        images.append(img)
+        metadata.extend(meta)
+    return np.concatenate(images, axis=2), metadata
+
+
+def test_read_16bit_full_precision(tmp_path):
+    rng = np.random.RandomState(0)
+    frames = [rng.randint(0, 65536, (32, 48)).astype(np.uint16) for _ in range(0, 3)]
+    for i in range(0, len(frames)):
+        cv2.imwrite(str(tmp_path / ("frame%d.png" % (i))), frames[i])
+    names = ["20200101_0600%02d_atha_nascam02_full_2000ms.png" % (i) for i in range(0, len(frames))]
+    filename = str(tmp_path / "20200101_0600_atha_nascam02_full.png.tar")
+    with tarfile.open(filename, "w") as tf:
+        for i in range(0, len(frames)):
+            tf.add(str(tmp_path / ("frame%d.png" % (i))), arcname=names[i])
+
+    img, meta, problematic_files = nascam_imager_readfile.read(filename)
+    assert img.dtype == np.uint16
+    assert img.shape == (32, 48, 3)
+    assert len(meta) == 3
+    assert problematic_files == []
+    for i in range(0, len(frames)):
+        assert np.array_equal(img[:, :, i], frames[i])
+
+
+def test_read_multiple_files_matches_single_files(tmp_path):
+    # 25 frames doesn't fit in a shared memory slot, so that file is returned through the pool instead
+    file_list = [
+        write_png_tar(tmp_path / "20200101_0600_atha_nascam02_full.png.tar", make_frames(20, seed=1)),
+        write_png_tar(tmp_path / "20200101_0601_atha_nascam02_full.png.tar", make_frames(25, seed=2)),
+        write_png_tar(tmp_path / "20200101_0602_atha_nascam02_full.png.tar", make_frames(13, seed=3)),
+    ]
+    expected_img, expected_meta = read_each(file_list)
+
+    for workers in [1, 2]:
+        img, meta, problematic_files = nascam_imager_readfile.read(file_list, workers=workers)
+        assert img.shape == (24, 32, 58)
+        assert np.array_equal(img, expected_img)
+        assert meta == expected_meta
+        assert problematic_files == []
+
+
+def test_read_multiple_files_more_than_predicted_frames(tmp_path):
+    # the frames run past the shared memory slots and the predicted array size
+    file_list = [
+        write_png_tar(tmp_path / "20200101_0600_atha_nascam02_full.png.tar", make_frames(15, seed=1)),
+        write_png_tar(tmp_path / "20200101_0601_atha_nascam02_full.png.tar", make_frames(25, seed=2)),
+        write_png_tar(tmp_path / "20200101_0602_atha_nascam02_full.png.tar", make_frames(30, seed=3)),
+    ]
+    expected_img, expected_meta = read_each(file_list)
+
+    for workers in [1, 2]:
+        img, meta, problematic_files = nascam_imager_readfile.read(file_list, workers=workers)
+        assert img.shape == (24, 32, 70)
+        assert np.array_equal(img, expected_img)
+        assert meta == expected_meta
+        assert problematic_files == []
+
+
+def test_worker_shared_memory_slot(tmp_path):
+    create_shared_memory = getattr(_nascam, "__create_shared_memory")
+    readfile_worker = getattr(_nascam, "__nascam_readfile_worker")
+    file_list = [
+        write_png_tar(tmp_path / "20200101_0600_atha_nascam02_full.png.tar", make_frames(20, seed=1)),
+        write_png_tar(tmp_path / "20200101_0601_atha_nascam02_full.png.tar", make_frames(25, seed=2)),
+    ]
+    shm, shared_buffer, shm_frame_shape = create_shared_memory(file_list, 2 * 20)
+    assert shm is not None
+    assert shm_frame_shape == (24, 32)
+    try:
+        worker_data = []
+        for i in range(0, len(file_list)):
+            worker_data.append(readfile_worker({
+                "filename": file_list[i],
+                "decode_threads": 1,
+                "shm_name": shm.name,
+                "shm_inherited": False,
+                "shm_frame_shape": shm_frame_shape,
+                "shm_slot": i,
+            }))
+
+        # frames fitting in the slot are written to shared memory, others are returned
+        shm_images = np.ndarray([2 * 20, 24, 32], dtype=np.uint16, buffer=shared_buffer)
+        assert worker_data[0][0] is None
+        assert np.array_equal(shm_images[0:20], np.array(make_frames(20, seed=1)))
+        assert worker_data[1][0].shape == (25, 24, 32)
+        assert np.array_equal(worker_data[1][0], np.array(make_frames(25, seed=2)))
+        shm_images = None
+        shared_buffer = None
+    finally:
+        shm.close()
+        shm.unlink()
+
+
+def test_shared_memory_disabled_for_missing_first_file(tmp_path):
+    create_shared_memory = getattr(_nascam, "__create_shared_memory")
+    file_list = [
+        str(tmp_path / "20200101_0600_atha_nascam02_full.png.tar"),
+        write_png_tar(tmp_path / "20200101_0601_atha_nascam02_full.png.tar", make_frames(20)),
+    ]
+    assert create_shared_memory(file_list, 2 * 20) == (None, None, None)
+    assert create_shared_memory(file_list, 2 * 20, inherited=True) == (None, None, None)
+
+    img, meta, problematic_files = nascam_imager_readfile.read(file_list, workers=2)
+    assert np.array_equal(img, read_each(file_list[1:])[0])
+    assert len(meta) == 20
+    assert len(problematic_files) == 1
+    assert problematic_files[0]["filename"] == file_list[0]
+
+
+def test_read_single_file_without_pool(tmp_path, monkeypatch):
+    def no_pool(*args, **kwargs):
+        raise AssertionError("a process pool should not be used for a single file")
+    monkeypatch.setattr(_nascam.multiprocessing, "get_context", no_pool)
+
+    frames = make_frames(20)
+    filename = write_png_tar(tmp_path / "20200101_0600_atha_nascam02_full.png.tar", frames)
+    for file_list in [filename, [filename]]:
+        img, meta, problematic_files = nascam_imager_readfile.read(file_list, workers=4)
+        assert img.shape == (24, 32, 20)
+        assert np.array_equal(img, np.dstack(frames))
+        assert len(meta) == 20
+        assert meta[1] == {
+            "Project unique ID": "nascam",
+            "Site unique ID": "atha",
+            "Imager unique ID": "nascam02",
+            "Mode unique ID": "full",
+            "Image request start": datetime.datetime(2020, 1, 1, 6, 0, 1),
+            "Subframe requested exposure": "2000.000 ms",
+        }
+        assert problematic_files == []
+
+
+def test_read_metadata_fallback_for_bad_filename(tmp_path):
+    names = [
+        "20200101_060000_atha_nascam02_full_2000ms.png",
+        "20200101_060001_atha_nascam02_full_2000ms.png",
+        "20200101_0600ab_atha_nascam02_full_2000ms.png",
+        "20200101_060003_atha_nascam02_full_2000ms.png",
+    ]
+    filename_regex = getattr(_nascam, "__PNG_FILENAME_REGEX")
+    assert filename_regex.match(names[0]) is not None
+    assert filename_regex.match(names[0] + "\n") is None
+    assert filename_regex.match(names[2]) is None
+    frames = make_frames(4)
+    filename = write_png_tar(tmp_path / "20200101_0600_atha_nascam02_full.png.tar", frames, names=names)
+
+    # frames are read until the bad filename (sorted last)
+    img, meta, problematic_files = nascam_imager_readfile.read(filename)
+    assert img.shape == (24, 32, 3)
+    assert np.array_equal(img, np.dstack([frames[0], frames[1], frames[3]]))
+    assert [m["Image request start"].second for m in meta] == [0, 1, 3]
+    assert len(problematic_files) == 1
+    assert problematic_files[0]["error_message"].startswith("failed to read metadata")
+
+
+def test_read_truncated_frame(tmp_path):
+    frames = make_frames(5)
+    png_data = cv2.imencode(".png", frames[2])[1].tobytes()
+    filename = write_png_tar(
+        tmp_path / "20200101_0600_atha_nascam02_full.png.tar",
+        frames[0:2] + [png_data[0:len(png_data) // 2]] + frames[3:],
+    )
+
+    img, meta, problematic_files = nascam_imager_readfile.read(filename)
+    assert img.shape == (24, 32, 4)
+    assert np.array_equal(img, np.dstack(frames[0:2] + frames[3:]))
+    assert len(meta) == 4
+    assert len(problematic_files) == 1
+    assert problematic_files[0]["error_message"].startswith("image data read failure")
+
+
+def test_read_gzip_compressed_tar(tmp_path):
+    frames = make_frames(20)
+    filename = write_png_tar(tmp_path / "20200101_0600_atha_nascam02_full.png.tar", frames, mode="w:gz")
+
+    img, meta, problematic_files = nascam_imager_readfile.read(filename)
+    assert np.array_equal(img, np.dstack(frames))
+    assert len(meta) == 20
+    assert problematic_files == []
+
+
+def test_read_no_files():
+    img, meta, problematic_files = nascam_imager_readfile.read([], workers=2)
+    assert img.shape == (0, 0, 0)
+    assert meta == []
+    assert problematic_files == []
+
+
+def test_read_missing_png(tmp_path):
+    filename = str(tmp_path / "20200101_060000_atha_nascam02_full_2000ms.png")
+    img, meta, problematic_files = nascam_imager_readfile.read(filename)
+    assert img.shape == (0, 0, 0)
+    assert meta == []
+    assert len(problematic_files) == 1
+    assert problematic_files[0]["filename"] == filename
+    assert problematic_files[0]["error_message"].startswith("failed to open file")
+
+
+def test_read_invalid_workers():
+    with pytest.raises(ValueError):
+        nascam_imager_readfile.read([], workers=0)
+
+
+def test_read_all_cpu_workers(tmp_path):
+    file_list = [
+        write_png_tar(tmp_path / "20200101_0600_atha_nascam02_full.png.tar", make_frames(20, seed=1)),
+        write_png_tar(tmp_path / "20200101_0601_atha_nascam02_full.png.tar", make_frames(20, seed=2)),
+    ]
+    img, meta, problematic_files = nascam_imager_readfile.read(file_list, workers=None)
+    assert np.array_equal(img, read_each(file_list)[0])
+    assert len(meta) == 40
+    assert problematic_files == []